@@ -3,16 +3,23 @@
 #
 # CSV: Название;Новый_текст;Координаты (UTF-8, ; delimiter)
 # ----------------------------------------------------------------------------
-import os, sys, math, csv, sqlite3, textwrap, html, logging
+import os, sys, math, csv, sqlite3, textwrap, logging, time, asyncio, secrets
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from contextlib import contextmanager, asynccontextmanager
+from functools import lru_cache, partial
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
 
+import numpy as np
+import orjson
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+    ApplicationBuilder, AIORateLimiter, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 )
-from telegram.error import BadRequest as TgBad
+from telegram.error import TelegramError
 
 # ── базовые настройки логирования ───────────────────────────────────────────
 logging.basicConfig(
@@ -26,105 +33,223 @@ BOT_TOKEN = os.getenv("BOT_TOKEN") or ""
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN env var is missing")
 
+# Публичный https-адрес приложения: если задан, апдейты приходят webhook-ом
+# на /webhook, иначе бот сам опрашивает Telegram (локальный запуск)
+PUBLIC_URL     = (os.getenv("PUBLIC_URL") or "").rstrip("/")
+# Секрет обязателен: без него /webhook принял бы апдейт от кого угодно.
+# Если не задан — свой на каждый запуск, set_webhook всё равно передаёт его Telegram
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# Только те апдейты, что обрабатываем; live-локация приходит как edited_message
+ALLOWED_UPDATES = ["message", "edited_message", "callback_query"]
+# Telegram id администратора для /reload; без него — любой пользователь в личке
+ADMIN_ID = int(os.getenv("ADMIN_ID") or 0) or None
+
 DB              = ".data/poi.sqlite"
 RADIUS          = 20           # м для авто-показа
 REVISIT_HOURS   = 24          # повтор через … часов
 LOCATIONS_FILE  = "locations.csv"
+CSV_BATCH       = 5000         # строк на один executemany
+LIVE_EDIT_EVERY = 1.0          # с, не чаще одного edit_text на пользователя
+ROUTE_QUEUE     = 10           # точек в очереди «Следующее место»
 
 # ── DB helpers ───────────────────────────────────────────────────────────────
 def connect_db():
-    c = sqlite3.connect(DB, check_same_thread=False)
+    # Кэш подготовленных выражений ищет по тексту SQL: на постоянном
+    # соединении каждый запрос разбирается один раз. Запас с избытком,
+    # чтобы редкие админские запросы не вытесняли горячие.
+    # isolation_level=None: транзакции открываем сами в db_write()
+    c = sqlite3.connect(DB, isolation_level=None, cached_statements=512)
     c.row_factory = sqlite3.Row
-    c.create_function("sqrt", 1, math.sqrt)
-    c.create_function("pow",  2, math.pow)
+    # Настройки соединения (journal_mode=WAL хранится в самом файле, см. init_db):
+    # без fsync на каждый commit, ожидание вместо SQLITE_BUSY, кэш ~32 МБ
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA busy_timeout=5000")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA cache_size=-32000")
+    c.execute("PRAGMA mmap_size=67108864")
     return c
 
+# Одно соединение на весь процесс: open на каждый live-апдейт обходился
+# дороже самих запросов. Им владеет отдельный поток (как в aiosqlite):
+# все запросы идут через run_db, выполняются по очереди и не занимают
+# event loop, а обращение из чужого потока sqlite3 сразу отклонит.
+os.makedirs(".data", exist_ok=True)
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+DB_CONN = DB_EXECUTOR.submit(connect_db).result()
+
+@contextmanager
+def db_write():
+    """Транзакция записи на общем соединении (commit/rollback на выходе).
+    BEGIN IMMEDIATE берёт блокировку записи сразу, а не посреди транзакции."""
+    DB_CONN.execute("BEGIN IMMEDIATE")
+    try:
+        yield DB_CONN
+        DB_CONN.execute("COMMIT")
+    except BaseException:
+        # Транзакция могла уже откатиться сама (часть ошибок SQLite так делает);
+        # иначе откатываем, чтобы следующий BEGIN не упал на незакрытой
+        if DB_CONN.in_transaction:
+            DB_CONN.execute("ROLLBACK")
+        raise
+
+async def run_db(fn, *args, **kw):
+    """Выполняет DB-хелпер в потоке базы, не занимая event loop"""
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, partial(fn, *args, **kw))
+
 def init_db():
-    os.makedirs(".data", exist_ok=True)
-    with connect_db() as c:
-        c.executescript("""
-        CREATE TABLE IF NOT EXISTS poi(
-          id INTEGER PRIMARY KEY,
-          name_ru   TEXT,
-          lat       REAL,
-          lon       REAL,
-          summary_ru TEXT,
-          UNIQUE(name_ru, lat, lon)
-        );
-        CREATE TABLE IF NOT EXISTS visit_log(
-          id INTEGER PRIMARY KEY,
-          user_id  INTEGER,
-          poi_id   INTEGER,
-          visited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-        CREATE TABLE IF NOT EXISTS user_tracking(
-            user_id INTEGER PRIMARY KEY,
-            last_lat REAL,
-            last_lon REAL,
-            last_update TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            target_poi_id INTEGER,
-            notified_50m BOOLEAN DEFAULT 0,
-            notified_arrived BOOLEAN DEFAULT 0
-        );
-        CREATE TABLE IF NOT EXISTS user_stats(
-            user_id INTEGER PRIMARY KEY,
-            total_distance REAL DEFAULT 0,
-            total_time INTEGER DEFAULT 0,
-            first_visit DATE,
-            last_visit DATE,
-            current_streak INTEGER DEFAULT 0,
-            max_streak INTEGER DEFAULT 0,
-            favorite_poi_id INTEGER
-        );
-        CREATE TABLE IF NOT EXISTS user_sessions(
-            id INTEGER PRIMARY KEY,
-            user_id INTEGER,
-            start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            end_time TIMESTAMP,
-            distance REAL DEFAULT 0
-        );
-        CREATE TABLE IF NOT EXISTS user_interests(
-            user_id INTEGER,
-            interest TEXT,
-            PRIMARY KEY (user_id, interest)
-        );
-        """)
-
-def import_csv() -> int:
-    """Импортирует CSV, возвращает кол-во вставленных строк"""
+    # WAL: читатели не блокируют писателя; режим сохраняется в файле базы
+    DB_CONN.execute("PRAGMA journal_mode=WAL")
+    new_counts = not DB_CONN.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='poi_visit_count'").fetchone()
+    DB_CONN.executescript("""
+    CREATE TABLE IF NOT EXISTS poi(
+      id INTEGER PRIMARY KEY,
+      name_ru   TEXT,
+      lat       REAL,
+      lon       REAL,
+      summary_ru TEXT,
+      UNIQUE(name_ru, lat, lon)
+    );
+    CREATE TABLE IF NOT EXISTS visit_log(
+      id INTEGER PRIMARY KEY,
+      user_id  INTEGER,
+      poi_id   INTEGER,
+      visited_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_visit_user_time ON visit_log(user_id, visited_at, poi_id);
+    CREATE TABLE IF NOT EXISTS user_tracking(
+        user_id INTEGER PRIMARY KEY,
+        last_lat REAL,
+        last_lon REAL,
+        last_update TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        target_poi_id INTEGER,
+        notified_50m BOOLEAN DEFAULT 0,
+        notified_arrived BOOLEAN DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS user_stats(
+        user_id INTEGER PRIMARY KEY,
+        total_distance REAL DEFAULT 0,
+        total_time INTEGER DEFAULT 0,
+        first_visit DATE,
+        last_visit DATE,
+        current_streak INTEGER DEFAULT 0,
+        max_streak INTEGER DEFAULT 0,
+        favorite_poi_id INTEGER,
+        unique_visited INTEGER DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS user_sessions(
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        end_time TIMESTAMP,
+        distance REAL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS user_interests(
+        user_id INTEGER,
+        interest TEXT,
+        PRIMARY KEY (user_id, interest)
+    );
+    CREATE TABLE IF NOT EXISTS poi_visit_count(
+        user_id INTEGER,
+        poi_id INTEGER,
+        cnt INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, poi_id)
+    );
+    CREATE TABLE IF NOT EXISTS meta(
+        k TEXT PRIMARY KEY,
+        v
+    );
+    """)
+    with db_write() as c:
+        if new_counts:
+            # Счётчики появились позже журнала — заполняем из истории
+            c.execute("""
+                INSERT INTO poi_visit_count(user_id, poi_id, cnt)
+                SELECT user_id, poi_id, COUNT(*) FROM visit_log GROUP BY user_id, poi_id""")
+        if not any(r['name'] == 'unique_visited' for r in c.execute("PRAGMA table_info(user_stats)")):
+            c.execute("ALTER TABLE user_stats ADD COLUMN unique_visited INTEGER DEFAULT 0")
+            c.execute("""
+                UPDATE user_stats SET unique_visited =
+                  (SELECT COUNT(*) FROM poi_visit_count p WHERE p.user_id = user_stats.user_id)""")
+
+def import_csv(force: bool = False) -> int:
+    """Импортирует CSV, возвращает кол-во вставленных строк.
+    Если файл не менялся с прошлого импорта (mtime+размер), не перечитывает его."""
     if not os.path.exists(LOCATIONS_FILE):
         log.warning("%s not found — creating minimal demo file", LOCATIONS_FILE)
         with open(LOCATIONS_FILE, "w", encoding="utf-8") as f:
             f.write(textwrap.dedent("""Название;Новый_текст;Координаты
 Кавалерские дома 🏛️;**История:** 1752-1753 годы, архитектор Чевакинский создает эти барочные дома...;59.71618,30.39530
 """))
+    st = os.stat(LOCATIONS_FILE)
+    stamp = f"{st.st_mtime_ns}:{st.st_size}"
+    if not force:
+        row = DB_CONN.execute("SELECT v FROM meta WHERE k='csv_stamp'").fetchone()
+        if row and row['v'] == stamp:
+            log.info("CSV import: %s не менялся, точки берём из базы", LOCATIONS_FILE)
+            load_poi_cache()
+            return 0
     inserted = 0
-    skipped = 0
     total_rows = 0
-    with connect_db() as c:
+    errors = 0
+
+    def parsed(rdr):
+        nonlocal total_rows, errors
+        # Позиции колонок берём из заголовка один раз, дальше — по индексу
+        header = next(rdr, [])
+        try:
+            i_name, i_text, i_coord = map(header.index, ("Название", "Новый_текст", "Координаты"))
+        except ValueError:
+            log.error("CSV header mismatch: %s", header)
+            return
+        for row in rdr:
+            if not row:  # пустая строка — DictReader тоже её пропускал
+                continue
+            total_rows += 1
+            try:
+                lat, lon = map(float, row[i_coord].split(',', 1))
+                yield row[i_name].strip(), lat, lon, row[i_text].strip()
+            except Exception as e:
+                errors += 1
+                log.error("CSV error at row %d: %s → %s", total_rows, row, e)
+
+    # Одна транзакция на весь файл, строки пачками через executemany
+    with db_write() as c, open(LOCATIONS_FILE, newline="", encoding="utf-8") as f:
+        rows = parsed(csv.reader(f, delimiter=';', quotechar='"'))
         cursor = c.cursor()
-        with open(LOCATIONS_FILE, newline="", encoding="utf-8") as f:
-            rdr = csv.DictReader(f, delimiter=';', quotechar='"')
-            for i, row in enumerate(rdr, 1):
-                total_rows += 1
-                log.debug("Processing row %d: %s", i, row)
-                try:
-                    lat, lon = map(float, row['Координаты'].split(','))
-                    cursor.execute("""
-                        INSERT OR IGNORE INTO poi(name_ru, lat, lon, summary_ru)
-                        VALUES(?,?,?,?)""",
-                                  (row['Название'].strip(), lat, lon, row['Новый_текст'].strip()))
-                    if cursor.rowcount > 0:
-                        inserted += 1
-                        log.info("Imported row %d: %s", i, row['Название'])
-                    else:
-                        skipped += 1
-                        log.warning("Skipped duplicate row %d: %s (lat: %f, lon: %f)", i, row['Название'], lat, lon)
-                except Exception as e:
-                    log.error("CSV error at row %d: %s → %s", i, row, e)
-        log.info("CSV import: processed %s rows, +%s новых точек, %s пропущено", total_rows, inserted, skipped)
+        while True:
+            batch = list(islice(rows, CSV_BATCH))
+            if not batch:
+                break
+            cursor.executemany("""
+                INSERT OR IGNORE INTO poi(name_ru, lat, lon, summary_ru)
+                VALUES(?,?,?,?)""", batch)
+            inserted += cursor.rowcount
+        c.execute("INSERT OR REPLACE INTO meta(k, v) VALUES('csv_stamp', ?)", (stamp,))
+    log.info("CSV import: processed %s rows, +%s новых точек, %s пропущено, %s ошибок",
+             total_rows, inserted, total_rows - errors - inserted, errors)
+    load_poi_cache()
     return inserted
 
+# Точки меняются только при импорте CSV, поэтому держим их в памяти:
+# строки по id (с заранее экранированными name_esc/summary_esc для HTML)
+# и координаты столбцами (ids, lat, lon в микроградусах) для поиска
+POI_BY_ID: Dict[int, dict] = {}
+POI_COUNT = 0
+POI_SOA = (np.empty(0, np.int64), np.empty(0, np.int32), np.empty(0, np.int32))
+
+def load_poi_cache():
+    """Перечитывает точки из базы в память (после импорта и /reload)"""
+    global POI_BY_ID, POI_COUNT, POI_SOA
+    rows = DB_CONN.execute("SELECT * FROM poi ORDER BY id").fetchall()
+    n = len(rows)
+    POI_BY_ID = {r['id']: dict(r, name_esc=_esc(r['name_ru']), summary_esc=_esc(r['summary_ru']))
+                 for r in rows}
+    POI_COUNT = n
+    POI_SOA = (np.fromiter((r['id'] for r in rows), np.int64, n),
+               np.fromiter((round(r['lat'] * UDEG) for r in rows), np.int32, n),
+               np.fromiter((round(r['lon'] * UDEG) for r in rows), np.int32, n))
+
 # ── геопоиск ────────────────────────────────────────────────────────────────
 R_EARTH = 6_371_000
 
@@ -135,81 +260,141 @@ def haversine(lat1, lon1, lat2, lon2):
     a = math.sin(dφ/2)**2 + math.cos(φ1)*math.cos(φ2)*math.sin(dλ/2)**2
     return 2*R_EARTH*math.asin(math.sqrt(a))
 
+@lru_cache(maxsize=64)
+def _cos_lat(band: int) -> float:
+    """cos широты полосы в 0.1° — в пределах города это константа"""
+    return math.cos(math.radians(band / 10))
+
+def short_distance(lat1, lon1, lat2, lon2):
+    """Расстояние в метрах между близкими точками (равнопромежуточная проекция)"""
+    dx = (lon2 - lon1) * _cos_lat(round((lat1 + lat2) * 5)) * 111319.9
+    dy = (lat2 - lat1) * 110574.0
+    return math.sqrt(dx*dx + dy*dy)
+
+def _with_dist(row, lat: float, lon: float) -> dict:
+    """Строка poi + точное расстояние до неё в метрах"""
+    p = dict(row)
+    p['dist'] = haversine(lat, lon, row['lat'], row['lon'])
+    return p
+
+def visited_recently(uid: int) -> set:
+    """id точек, которые пользователь видел за последние REVISIT_HOURS"""
+    since = datetime.utcnow() - timedelta(hours=REVISIT_HOURS)
+    return {r[0] for r in DB_CONN.execute(
+        "SELECT poi_id FROM visit_log WHERE user_id=? AND visited_at>?", (uid, since))}
+
+UDEG = 1_000_000                # координаты в памяти — целые микроградусы
+FAR  = np.iinfo(np.int64).max   # «исключено» для целочисленных расстояний
+
+def _d2(plat, plon, lat_ud: int, lon_ud: int):
+    """Квадраты расстояний (мкград², долгота с коэф. 0.6) до всех точек"""
+    dlat = (plat - lat_ud).astype(np.int64)
+    dlon = (plon - lon_ud).astype(np.int64)
+    return dlat*dlat + dlon*dlon*36 // 100
+
+def _nearest_unvisited(uid: int, lat: float, lon: float, k: int, radius: Optional[float] = None):
+    """k ближайших непосещенных точек (не дальше radius метров, если задан)"""
+    # Векторный скан по столбцам координат: квадрат расстояния для всех
+    # точек сразу, посещённые и слишком далёкие выкидываем через FAR
+    ids, plat, plon = POI_SOA
+    d2 = _d2(plat, plon, round(lat * UDEG), round(lon * UDEG))
+    visited = visited_recently(uid)
+    if visited:
+        d2[np.isin(ids, list(visited))] = FAR
+    if radius is not None:
+        r = radius / 111000.0 * UDEG
+        d2[d2 > r*r] = FAR
+    k = min(k, len(d2))
+    if k == 0:
+        return []
+    idx = np.argpartition(d2, k - 1)[:k]
+    idx = idx[np.argsort(d2[idx])]
+    return [_with_dist(POI_BY_ID[int(ids[i])], lat, lon) for i in idx if d2[i] != FAR]
+
 def nearest(uid: int, lat: float, lon: float):
-    limit = datetime.utcnow() - timedelta(hours=REVISIT_HOURS)
-    with connect_db() as c:
-        return c.execute("""
-        SELECT *, 111000*sqrt(pow(lat-?,2)+pow((lon-?)*0.6,2)) AS dist
-        FROM poi WHERE NOT EXISTS(
-          SELECT 1 FROM visit_log WHERE user_id=? AND poi_id=poi.id AND visited_at>? )
-        AND 111000*sqrt(pow(lat-?,2)+pow((lon-?)*0.6,2)) <= ?
-        ORDER BY dist LIMIT 1""", (lat, lon, uid, limit, lat, lon, RADIUS)).fetchone()
+    rows = _nearest_unvisited(uid, lat, lon, 1, RADIUS)
+    return rows[0] if rows else None
 
 def find_nearest_unvisited(uid: int, lat: float, lon: float, limit: int = 3):
     """Находит несколько ближайших непосещенных точек"""
-    time_limit = datetime.utcnow() - timedelta(hours=REVISIT_HOURS)
-    with connect_db() as c:
-        return c.execute("""
-        SELECT *, 111000*sqrt(pow(lat-?,2)+pow((lon-?)*0.6,2)) AS dist
-        FROM poi WHERE NOT EXISTS(
-          SELECT 1 FROM visit_log WHERE user_id=? AND poi_id=poi.id AND visited_at>? )
-        ORDER BY dist LIMIT ?""", (lat, lon, uid, time_limit, limit)).fetchall()
+    return _nearest_unvisited(uid, lat, lon, limit)
+
+def plan_route(uid: int, lat: float, lon: float, n: int, skip=()) -> List[int]:
+    """Жадный маршрут: до n непосещенных точек, каждая ближайшая к предыдущей"""
+    ids, plat, plon = POI_SOA
+    free = ~np.isin(ids, list(visited_recently(uid).union(skip)))
+    lat_ud, lon_ud = round(lat * UDEG), round(lon * UDEG)
+    route = []
+    while len(route) < n and free.any():
+        d2 = _d2(plat, plon, lat_ud, lon_ud)
+        d2[~free] = FAR
+        i = int(np.argmin(d2))
+        free[i] = False
+        route.append(int(ids[i]))
+        lat_ud, lon_ud = int(plat[i]), int(plon[i])
+    return route
 
 def get_poi_by_id(poi_id: int):
-    with connect_db() as c:
-        return c.execute("SELECT * FROM poi WHERE id=?", (poi_id,)).fetchone()
+    return POI_BY_ID.get(poi_id)
 
 def mark_visit(uid: int, pid: int):
-    with connect_db() as c:
+    """Записывает посещение и обновляет статистику одной транзакцией"""
+    with db_write() as c:
         c.execute("INSERT INTO visit_log(user_id, poi_id) VALUES(?,?)", (uid, pid))
-        # Обновляем статистику посещений
-        update_visit_stats(uid)
-
-def update_visit_stats(uid: int):
-    """Обновляет статистику пользователя после посещения"""
-    with connect_db() as c:
-        # Инициализируем запись если её нет
+        c.execute("INSERT OR IGNORE INTO poi_visit_count(user_id, poi_id) VALUES(?,?)", (uid, pid))
+        c.execute("UPDATE poi_visit_count SET cnt = cnt + 1 WHERE user_id=? AND poi_id=?", (uid, pid))
         c.execute("INSERT OR IGNORE INTO user_stats(user_id, first_visit) VALUES(?, date('now'))", (uid,))
-        c.execute("UPDATE user_stats SET last_visit = date('now') WHERE user_id=?", (uid,))
         
-        # Обновляем любимое место
-        fav = c.execute("""
-            SELECT poi_id, COUNT(*) as cnt FROM visit_log 
-            WHERE user_id=? GROUP BY poi_id ORDER BY cnt DESC LIMIT 1
-        """, (uid,)).fetchone()
-        if fav:
-            c.execute("UPDATE user_stats SET favorite_poi_id=? WHERE user_id=?", (fav['poi_id'], uid))
+        # Любимое место меняется, только если эту точку теперь посещали чаще
+        row = c.execute("""
+            SELECT pv.cnt, fv.cnt AS fav_cnt, s.favorite_poi_id
+            FROM user_stats s
+            JOIN poi_visit_count pv ON pv.user_id = s.user_id AND pv.poi_id = ?
+            LEFT JOIN poi_visit_count fv ON fv.user_id = s.user_id AND fv.poi_id = s.favorite_poi_id
+            WHERE s.user_id=?""", (pid, uid)).fetchone()
+        fav = pid if row['cnt'] > (row['fav_cnt'] or 0) else row['favorite_poi_id']
+        c.execute("""
+            UPDATE user_stats SET last_visit = date('now'), favorite_poi_id=?,
+                                  unique_visited = unique_visited + ?
+            WHERE user_id=?""", (fav, row['cnt'] == 1, uid))
 
 # ── навигация ───────────────────────────────────────────────────────────────
+DIRECTIONS = ("⬆️", "↗️", "➡️", "↘️", "⬇️", "↙️", "⬅️", "↖️")
+
 def get_direction(lat1, lon1, lat2, lon2):
     """Возвращает эмодзи направления"""
-    dlon = lon2 - lon1
-    y = math.sin(math.radians(dlon)) * math.cos(math.radians(lat2))
-    x = math.cos(math.radians(lat1)) * math.sin(math.radians(lat2)) - \
-        math.sin(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.cos(math.radians(dlon))
-    bearing = math.degrees(math.atan2(y, x))
-    bearing = (bearing + 360) % 360
-    
-    directions = ["⬆️", "↗️", "➡️", "↘️", "⬇️", "↙️", "⬅️", "↖️"]
-    index = round(bearing / 45) % 8
-    return directions[index]
+    # На расстояниях прогулки азимут в плоской проекции совпадает с
+    # ортодромическим с точностью много лучше 45° одного сектора
+    dy = lat2 - lat1
+    dx = (lon2 - lon1) * _cos_lat(round((lat1 + lat2) * 5))
+    return DIRECTIONS[round(math.atan2(dx, dy) / (math.pi / 4)) % 8]
 
 def set_navigation_target(uid: int, poi_id: int):
     """Устанавливает цель для навигации"""
-    with connect_db() as c:
+    with db_write() as c:
         c.execute("""
             INSERT OR REPLACE INTO user_tracking(user_id, target_poi_id, notified_50m, notified_arrived)
             VALUES(?, ?, 0, 0)
         """, (uid, poi_id))
 
+def get_tracking(uid: int):
+    """Последняя позиция и состояние навигации пользователя"""
+    return DB_CONN.execute("SELECT * FROM user_tracking WHERE user_id=?", (uid,)).fetchone()
+
+def mark_notified(uid: int, arrived: bool):
+    """Запоминает, что подсказка (50 м или прибытие) уже показана"""
+    col = "notified_arrived" if arrived else "notified_50m"
+    with db_write() as c:
+        c.execute(f"UPDATE user_tracking SET {col}=1 WHERE user_id=?", (uid,))
+
 def clear_navigation_target(uid: int):
     """Очищает цель навигации"""
-    with connect_db() as c:
+    with db_write() as c:
         c.execute("UPDATE user_tracking SET target_poi_id=NULL, notified_50m=0, notified_arrived=0 WHERE user_id=?", (uid,))
 
 def update_user_position(uid: int, lat: float, lon: float):
     """Обновляет позицию пользователя и считает пройденное расстояние"""
-    with connect_db() as c:
+    with db_write() as c:
         # Инициализируем запись в user_stats если её нет
         c.execute("INSERT OR IGNORE INTO user_stats(user_id, first_visit) VALUES(?, date('now'))", (uid,))
         
@@ -226,7 +411,7 @@ def update_user_position(uid: int, lat: float, lon: float):
         
         # Если есть предыдущая позиция - считаем расстояние
         if last and last['last_lat']:
-            dist = haversine(last['last_lat'], last['last_lon'], lat, lon)
+            dist = short_distance(last['last_lat'], last['last_lon'], lat, lon)
             if dist > 5:  # Игнорируем микродвижения
                 c.execute(
                     "UPDATE user_stats SET total_distance = total_distance + ? WHERE user_id=?",
@@ -244,23 +429,22 @@ INTERESTS = {
 
 def get_user_interests(uid: int) -> List[str]:
     """Получает интересы пользователя"""
-    with connect_db() as c:
-        rows = c.execute("SELECT interest FROM user_interests WHERE user_id=?", (uid,)).fetchall()
-        return [r['interest'] for r in rows]
+    rows = DB_CONN.execute("SELECT interest FROM user_interests WHERE user_id=?", (uid,)).fetchall()
+    return [r['interest'] for r in rows]
 
 def add_user_interest(uid: int, interest: str):
     """Добавляет интерес пользователя"""
-    with connect_db() as c:
+    with db_write() as c:
         c.execute("INSERT OR IGNORE INTO user_interests(user_id, interest) VALUES(?, ?)", (uid, interest))
 
 def remove_user_interest(uid: int, interest: str):
     """Удаляет интерес пользователя"""
-    with connect_db() as c:
+    with db_write() as c:
         c.execute("DELETE FROM user_interests WHERE user_id=? AND interest=?", (uid, interest))
 
-def get_personalized_description(poi: sqlite3.Row, interests: List[str]) -> str:
-    """Адаптирует описание под интересы пользователя"""
-    text = poi['summary_ru']
+def get_personalized_description(poi: dict, interests: List[str]) -> str:
+    """Адаптирует описание под интересы пользователя (уже экранировано для HTML)"""
+    text = poi['summary_esc']
     
     # В реальном боте здесь были бы разные тексты для разных интересов
     # Пока просто добавляем эмодзи-подсказки
@@ -278,14 +462,16 @@ def get_personalized_description(poi: sqlite3.Row, interests: List[str]) -> str:
     return text
 
 # ── helpers ─────────────────────────────────────────────────────────────────
-html_escape = html.escape
+def _esc(s: str) -> str:
+    """Экранирование для текста внутри тегов: кавычки трогать не нужно.
+    Цепочка replace на кириллице быстрее и html.escape, и str.translate."""
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
 def maps_link(lat, lon):
     return f"https://yandex.ru/maps/?ll={lon},{lat}&z=17&pt={lon},{lat},pm2rdm"
 
 def poi_count():
-    with connect_db() as c:
-        return c.execute("SELECT COUNT(*) FROM poi").fetchone()[0]
+    return POI_COUNT
 
 # ── Telegram handlers ───────────────────────────────────────────────────────
 WELCOME = textwrap.dedent("""
@@ -304,14 +490,16 @@ WELCOME = textwrap.dedent("""
 /reload — перечитать locations.csv (админ)
 """)
 
+def init_user_stats(uid: int):
+    with db_write() as c:
+        c.execute("INSERT OR IGNORE INTO user_stats(user_id, first_visit) VALUES(?, date('now'))", (uid,))
+
 async def cmd_start(u: Update, _):
     kb = [[KeyboardButton("📍 Отправить геолокацию", request_location=True)]]
     await u.message.reply_text(WELCOME, reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True), parse_mode='HTML')
     
     # Инициализируем статистику
-    uid = u.effective_user.id
-    with connect_db() as c:
-        c.execute("INSERT OR IGNORE INTO user_stats(user_id, first_visit) VALUES(?, date('now'))", (uid,))
+    await run_db(init_user_stats, u.effective_user.id)
 
 # ── статистика и достижения ─────────────────────────────────────────────────
 LEVELS = [
@@ -324,8 +512,8 @@ LEVELS = [
 ]
 
 def user_stats(uid: int):
-    with connect_db() as c:
-        visited = c.execute("SELECT COUNT(DISTINCT poi_id) FROM visit_log WHERE user_id=?", (uid,)).fetchone()[0]
+    row = DB_CONN.execute("SELECT unique_visited FROM user_stats WHERE user_id=?", (uid,)).fetchone()
+    visited = row['unique_visited'] if row else 0
     total = poi_count()
     title = "💫 Гость"  # default
     for n, t in LEVELS:
@@ -340,30 +528,42 @@ def next_level_info(visited: int):
             return n - visited, title
     return 0, None
 
+BAR_WIDTH = 30
+BAR_FULL  = "▓" * BAR_WIDTH
+BAR_EMPTY = "░" * BAR_WIDTH
+
 async def cmd_stats(u: Update, _):
-    v, tot, title = user_stats(u.effective_user.id)
-    bar = "▓"*v + "░"*(max(tot,1)-v)
-    await u.message.reply_text(f"<b>Достижения</b>\n{title}\n\n{v}/{tot} мест\n<code>{bar[:30]}</code>", parse_mode='HTML')
+    v, tot, title = await run_db(user_stats, u.effective_user.id)
+    # По клетке на место, обрезано до BAR_WIDTH — срезы готовых строк
+    width = min(max(tot, 1), BAR_WIDTH)
+    n = min(v, width)
+    bar = BAR_FULL[:n] + BAR_EMPTY[:width - n]
+    await u.message.reply_text(f"<b>Достижения</b>\n{title}\n\n{v}/{tot} мест\n<code>{bar}</code>", parse_mode='HTML')
+
+def user_summary(uid: int):
+    """Строка user_stats и общее число посещений (None, 0 — если нет записи)"""
+    stats = DB_CONN.execute("SELECT * FROM user_stats WHERE user_id=?", (uid,)).fetchone()
+    if not stats:
+        return None, 0
+    return stats, DB_CONN.execute("SELECT COUNT(*) FROM visit_log WHERE user_id=?", (uid,)).fetchone()[0]
 
 async def cmd_mystats(u: Update, _):
     """Подробная статистика пользователя"""
     uid = u.effective_user.id
-    with connect_db() as c:
-        stats = c.execute("SELECT * FROM user_stats WHERE user_id=?", (uid,)).fetchone()
-        
-        if not stats:
-            await u.message.reply_text("Вы еще не начали исследование. Отправьте геолокацию!")
-            return
-        
-        visited_count = c.execute("SELECT COUNT(DISTINCT poi_id) FROM visit_log WHERE user_id=?", (uid,)).fetchone()[0]
-        total_visits = c.execute("SELECT COUNT(*) FROM visit_log WHERE user_id=?", (uid,)).fetchone()[0]
-        
-        # Любимое место
-        fav = None
-        if stats['favorite_poi_id']:
-            fav_poi = c.execute("SELECT name_ru FROM poi WHERE id=?", (stats['favorite_poi_id'],)).fetchone()
-            if fav_poi:
-                fav = fav_poi['name_ru']
+    stats, total_visits = await run_db(user_summary, uid)
+    
+    if not stats:
+        await u.message.reply_text("Вы еще не начали исследование. Отправьте геолокацию!")
+        return
+    
+    visited_count = stats['unique_visited']
+    
+    # Любимое место
+    fav = None
+    if stats['favorite_poi_id']:
+        fav_poi = get_poi_by_id(stats['favorite_poi_id'])
+        if fav_poi:
+            fav = fav_poi['name_esc']
     
     text = f"""
 📊 <b>Ваша статистика:</b>
@@ -383,8 +583,7 @@ async def cmd_route(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = u.effective_user.id
     
     # Получаем последнюю известную позицию
-    with connect_db() as c:
-        track = c.execute("SELECT last_lat, last_lon FROM user_tracking WHERE user_id=?", (uid,)).fetchone()
+    track = await run_db(get_tracking, uid)
     
     if not track or not track['last_lat']:
         await u.message.reply_text(
@@ -394,7 +593,7 @@ async def cmd_route(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     
     # Находим 3 ближайшие непосещенные точки
-    pois = find_nearest_unvisited(uid, track['last_lat'], track['last_lon'], limit=3)
+    pois = await run_db(find_nearest_unvisited, uid, track['last_lat'], track['last_lon'], limit=3)
     
     if not pois:
         await u.message.reply_text("Вы изучили все места поблизости! Попробуйте /reset для нового путешествия.")
@@ -406,7 +605,7 @@ async def cmd_route(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     for i, poi in enumerate(pois, 1):
         dist = round(poi['dist'])
         direction = get_direction(track['last_lat'], track['last_lon'], poi['lat'], poi['lon'])
-        text += f"{i}. {poi['name_ru']} {direction} {dist}м\n"
+        text += f"{i}. {poi['name_esc']} {direction} {dist}м\n"
         buttons.append([InlineKeyboardButton(f"{i}. {poi['name_ru']}", callback_data=f"navigate_{poi['id']}")])
     
     text += "\n<i>Выберите место для навигации:</i>"
@@ -414,25 +613,29 @@ async def cmd_route(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await u.message.reply_text(text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(buttons))
 
 # ── интересы ────────────────────────────────────────────────────────────────
+# Кнопки не меняются — создаём один раз: (выбран, не выбран) на интерес
+INTEREST_BUTTONS = {
+    key: (InlineKeyboardButton(f"✅ {name}", callback_data=f"interest_remove_{key}"),
+          InlineKeyboardButton(name, callback_data=f"interest_add_{key}"))
+    for key, name in INTERESTS.items()
+}
+INTERESTS_DONE_ROW = (InlineKeyboardButton("💾 Сохранить", callback_data="interests_done"),)
+
+def build_interests_kb(current) -> InlineKeyboardMarkup:
+    """Клавиатура интересов из готовых кнопок"""
+    rows = tuple((on,) if key in current else (off,) for key, (on, off) in INTEREST_BUTTONS.items())
+    return InlineKeyboardMarkup(rows + (INTERESTS_DONE_ROW,))
+
 async def cmd_interests(u: Update, _):
     """Настройка интересов пользователя"""
     uid = u.effective_user.id
-    current = get_user_interests(uid)
-    
-    buttons = []
-    for key, name in INTERESTS.items():
-        if key in current:
-            buttons.append([InlineKeyboardButton(f"✅ {name}", callback_data=f"interest_remove_{key}")])
-        else:
-            buttons.append([InlineKeyboardButton(name, callback_data=f"interest_add_{key}")])
-    
-    buttons.append([InlineKeyboardButton("💾 Сохранить", callback_data="interests_done")])
+    current = set(await run_db(get_user_interests, uid))
     
     text = "🎯 <b>Выберите ваши интересы:</b>\n\nЯ буду подбирать информацию специально для вас!"
     if current:
         text += "\n\n<i>Активные интересы помечены ✅</i>"
     
-    await u.message.reply_text(text, reply_markup=InlineKeyboardMarkup(buttons), parse_mode='HTML')
+    await u.message.reply_text(text, reply_markup=build_interests_kb(current), parse_mode='HTML')
 
 # ── обработчики callback ────────────────────────────────────────────────────
 async def on_callback(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -477,8 +680,7 @@ async def on_callback(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 return
                 
             # Получаем текущую позицию пользователя
-            with connect_db() as c:
-                track = c.execute("SELECT last_lat, last_lon FROM user_tracking WHERE user_id=?", (uid,)).fetchone()
+            track = await run_db(get_tracking, uid)
             
             if track and track['last_lat']:
                 dist = haversine(track['last_lat'], track['last_lon'], poi['lat'], poi['lon'])
@@ -486,26 +688,33 @@ async def on_callback(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 dist = 0
             
             # Сохраняем старое количество посещений
-            visited_before, _, title_before = user_stats(uid)
+            visited_before, _, title_before = await run_db(user_stats, uid)
             
             # Отмечаем посещение
-            mark_visit(uid, poi['id'])
+            await run_db(mark_visit, uid, poi['id'])
             
             # Получаем интересы для персонализации
-            interests = get_user_interests(uid)
+            interests = await run_db(get_user_interests, uid)
             description = get_personalized_description(poi, interests)
             
             yandex_link = maps_link(poi['lat'], poi['lon'])
             
-            caption = (f"<b>{html_escape(poi['name_ru'])}</b>\n\n"
-                       f"{html_escape(description)}\n\n"
+            caption = (f"<b>{poi['name_esc']}</b>\n\n"
+                       f"{description}\n\n"
                        f"📍 {round(dist)} м | <a href='{yandex_link}'>Карта</a>")
             
-            # Ищем следующее место для новой кнопки
+            # Следующее место берём из очереди маршрута; если нажали кнопку
+            # не из неё (старое сообщение) — строим маршрут заново отсюда
+            queue = ctx.user_data.get('route_queue') or []
+            if queue[:1] == [poi['id']] and len(queue) > 1:
+                queue = queue[1:]
+            else:
+                queue = await run_db(plan_route, uid, poi['lat'], poi['lon'], ROUTE_QUEUE)
+            ctx.user_data['route_queue'] = queue
+            
             buttons = []
-            next_pois = find_nearest_unvisited(uid, poi['lat'], poi['lon'], limit=2)
-            if next_pois:
-                buttons.append([InlineKeyboardButton("➡️ Следующее место", callback_data=f"show_next_{next_pois[0]['id']}")])
+            if queue:
+                buttons.append([InlineKeyboardButton("➡️ Следующее место", callback_data=f"show_next_{queue[0]}")])
             
             # Добавляем кнопку навигации
             buttons.append([InlineKeyboardButton("🧭 Навести меня туда", callback_data=f"navigate_{poi['id']}")])
@@ -516,7 +725,7 @@ async def on_callback(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text(caption, parse_mode='HTML', disable_web_page_preview=False, reply_markup=keyboard)
             
             # Проверяем достижения
-            visited_after, total, title_after = user_stats(uid)
+            visited_after, total, title_after = await run_db(user_stats, uid)
             
             # Если получили новый уровень
             if title_after != title_before:
@@ -532,10 +741,10 @@ async def on_callback(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         elif data.startswith("navigate_"):
             log.info(f"Processing navigate callback")
             poi_id = int(data.split("_")[1])
-            set_navigation_target(uid, poi_id)
+            await run_db(set_navigation_target, uid, poi_id)
             poi = get_poi_by_id(poi_id)
             await query.edit_message_text(
-                f"🧭 Навигация к <b>{html_escape(poi['name_ru'])}</b> включена!\n\n"
+                f"🧭 Навигация к <b>{poi['name_esc']}</b> включена!\n\n"
                 f"Включите Live-локацию для получения подсказок по маршруту.",
                 parse_mode='HTML'
             )
@@ -543,16 +752,16 @@ async def on_callback(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
         # Интересы
         elif data.startswith("interest_add_"):
             interest = data.split("_")[2]
-            add_user_interest(uid, interest)
+            await run_db(add_user_interest, uid, interest)
             await cmd_interests_update(query)
         
         elif data.startswith("interest_remove_"):
             interest = data.split("_")[2]
-            remove_user_interest(uid, interest)
+            await run_db(remove_user_interest, uid, interest)
             await cmd_interests_update(query)
         
         elif data == "interests_done":
-            interests = get_user_interests(uid)
+            interests = await run_db(get_user_interests, uid)
             if interests:
                 text = "✅ Интересы сохранены!\n\nВаши интересы: " + ", ".join([INTERESTS[i] for i in interests])
             else:
@@ -569,22 +778,13 @@ async def on_callback(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_interests_update(query):
     """Обновляет сообщение с интересами"""
     uid = query.from_user.id
-    current = get_user_interests(uid)
-    
-    buttons = []
-    for key, name in INTERESTS.items():
-        if key in current:
-            buttons.append([InlineKeyboardButton(f"✅ {name}", callback_data=f"interest_remove_{key}")])
-        else:
-            buttons.append([InlineKeyboardButton(name, callback_data=f"interest_add_{key}")])
-    
-    buttons.append([InlineKeyboardButton("💾 Сохранить", callback_data="interests_done")])
+    current = set(await run_db(get_user_interests, uid))
     
     text = "🎯 <b>Выберите ваши интересы:</b>\n\nЯ буду подбирать информацию специально для вас!"
     if current:
         text += "\n\n<i>Активные интересы помечены ✅</i>"
     
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(buttons), parse_mode='HTML')
+    await query.edit_message_text(text, reply_markup=build_interests_kb(current), parse_mode='HTML')
 
 # ── основной обработчик локации ─────────────────────────────────────────────
 async def on_location(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -608,7 +808,7 @@ async def on_location(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     uid = u.effective_user.id
     
     # Обновляем позицию и статистику
-    update_user_position(uid, loc.latitude, loc.longitude)
+    await run_db(update_user_position, uid, loc.latitude, loc.longitude)
     
     # Проверяем, это обновление live location?
     if u.edited_message or (m.edit_date and m.location):
@@ -618,26 +818,46 @@ async def on_location(u: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Обычная локация - показываем ближайшее место
     await show_nearest_poi(u, ctx, loc)
 
+async def edit_live(ctx: ContextTypes.DEFAULT_TYPE, message, text: str, force: bool = False, **kw) -> bool:
+    """edit_text для live-навигации: без повторов и не чаще LIVE_EDIT_EVERY.
+    force — для переходов (50 м, прибытие), они уходят всегда.
+    Возвращает True, если на экране теперь этот текст."""
+    ud = ctx.user_data
+    # Последний текст помним для конкретного сообщения: у новой live-локации своё
+    sent = (message.chat_id, message.message_id, text)
+    if sent == ud.get('last_edit'):
+        return True
+    now = time.monotonic()
+    if not force and now - ud.get('last_edit_ts', 0) < LIVE_EDIT_EVERY:
+        return False
+    ud['last_edit_ts'] = now
+    try:
+        await message.edit_text(text, **kw)
+    except TelegramError as e:
+        log.warning("live edit failed for %s: %s", message.chat_id, e)
+        return False
+    ud['last_edit'] = sent
+    return True
+
 async def handle_live_location(u: Update, ctx: ContextTypes.DEFAULT_TYPE, loc):
     """Обработка live location для навигации"""
     uid = u.effective_user.id
     message = u.edited_message or u.effective_message  # Используем правильное сообщение
     
-    with connect_db() as c:
-        track = c.execute("SELECT * FROM user_tracking WHERE user_id=?", (uid,)).fetchone()
+    track = await run_db(get_tracking, uid)
     
     if not track or not track['target_poi_id']:
         # Нет цели - предлагаем выбрать
-        pois = find_nearest_unvisited(uid, loc.latitude, loc.longitude, limit=3)
+        pois = await run_db(find_nearest_unvisited, uid, loc.latitude, loc.longitude, limit=3)
         if pois:
             text = "🧭 <b>Выберите место для навигации:</b>\n\n"
             buttons = []
             for poi in pois:
                 dist = round(poi['dist'])
-                text += f"📍 {poi['name_ru']} - {dist}м\n"
+                text += f"📍 {poi['name_esc']} - {dist}м\n"
                 buttons.append([InlineKeyboardButton(poi['name_ru'], callback_data=f"navigate_{poi['id']}")])
             
-            await message.edit_text(text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(buttons))
+            await edit_live(ctx, message, text, parse_mode='HTML', reply_markup=InlineKeyboardMarkup(buttons))
         return
     
     # Есть цель - показываем навигацию
@@ -648,33 +868,28 @@ async def handle_live_location(u: Update, ctx: ContextTypes.DEFAULT_TYPE, loc):
     if dist <= RADIUS:
         # Прибыли!
         if not track['notified_arrived']:
-            await show_poi_info(u, poi, dist)
-            clear_navigation_target(uid)
-            with connect_db() as c:
-                c.execute("UPDATE user_tracking SET notified_arrived=1 WHERE user_id=?", (uid,))
+            await show_poi_info(u, ctx, poi, dist)
+            await run_db(clear_navigation_target, uid)
+            await run_db(mark_notified, uid, arrived=True)
     elif dist <= 50:
         # Близко
         if not track['notified_50m']:
-            text = f"🎯 Вы у цели!\n\n<b>{poi['name_ru']}</b>\nОсталось: {round(dist)}м {direction}"
-            await message.edit_text(text, parse_mode='HTML')
-            with connect_db() as c:
-                c.execute("UPDATE user_tracking SET notified_50m=1 WHERE user_id=?", (uid,))
+            text = f"🎯 Вы у цели!\n\n<b>{poi['name_esc']}</b>\nОсталось: {round(dist)}м {direction}"
+            if await edit_live(ctx, message, text, force=True, parse_mode='HTML'):
+                await run_db(mark_notified, uid, arrived=False)
     else:
         # Далеко - обновляем направление
-        text = f"🧭 <b>{poi['name_ru']}</b>\n\n📍 {round(dist)}м {direction}"
-        try:
-            await message.edit_text(text, parse_mode='HTML')
-        except:
-            pass  # Игнорируем ошибки если текст не изменился
+        text = f"🧭 <b>{poi['name_esc']}</b>\n\n📍 {round(dist)}м {direction}"
+        await edit_live(ctx, message, text, parse_mode='HTML')
 
 async def show_nearest_poi(u: Update, ctx: ContextTypes.DEFAULT_TYPE, loc):
     """Показывает информацию о ближайшей точке"""
     uid = u.effective_user.id
     
     # Сохраняем статистику ДО посещения
-    visited_before, total, title_before = user_stats(uid)
+    visited_before, total, title_before = await run_db(user_stats, uid)
     
-    p = nearest(uid, loc.latitude, loc.longitude)
+    p = await run_db(nearest, uid, loc.latitude, loc.longitude)
     if not p:
         await u.message.reply_text(
             "Рядом нет новых мест. Попробуйте:\n"
@@ -683,10 +898,10 @@ async def show_nearest_poi(u: Update, ctx: ContextTypes.DEFAULT_TYPE, loc):
         )
         return
     
-    await show_poi_info(u, p, haversine(loc.latitude, loc.longitude, p['lat'], p['lon']))
+    await show_poi_info(u, ctx, p, p['dist'])
     
     # Проверяем новый уровень
-    visited_after, _, title_after = user_stats(uid)
+    visited_after, _, title_after = await run_db(user_stats, uid)
     
     if title_after != title_before:
         # Поздравляем с новым уровнем!
@@ -705,7 +920,7 @@ async def show_nearest_poi(u: Update, ctx: ContextTypes.DEFAULT_TYPE, loc):
                 parse_mode='HTML'
             )
 
-async def show_poi_info(u: Update, poi: sqlite3.Row, distance: float):
+async def show_poi_info(u: Update, ctx: ContextTypes.DEFAULT_TYPE, poi: dict, distance: float):
     """Показывает информацию о точке интереса"""
     # Получаем uid правильно - из message или callback
     if u.message:
@@ -721,91 +936,161 @@ async def show_poi_info(u: Update, poi: sqlite3.Row, distance: float):
     log.info(f"show_poi_info: uid={uid}, poi_id={poi['id']}, poi_name={poi['name_ru']}")
     
     # Получаем интересы для персонализации
-    interests = get_user_interests(uid)
+    interests = await run_db(get_user_interests, uid)
     description = get_personalized_description(poi, interests)
     
     dist = round(distance)
     yandex_link = maps_link(poi['lat'], poi['lon'])
     
-    caption = (f"<b>{html_escape(poi['name_ru'])}</b>\n\n"
-               f"{html_escape(description)}\n\n"
+    caption = (f"<b>{poi['name_esc']}</b>\n\n"
+               f"{description}\n\n"
                f"📍 {dist} м | <a href='{yandex_link}'>Карта</a>")
     
-    # Кнопка для показа следующего места
+    # Маршрут для кнопки «Следующее место» строим один раз отсюда,
+    # дальнейшие нажатия берут точки из очереди без запросов к базе
     buttons = []
-    next_pois = find_nearest_unvisited(uid, poi['lat'], poi['lon'], limit=2)
+    queue = await run_db(plan_route, uid, poi['lat'], poi['lon'], ROUTE_QUEUE, skip=(poi['id'],))
+    ctx.user_data['route_queue'] = queue
     
-    log.info(f"Found {len(next_pois) if next_pois else 0} next POIs")
+    log.info(f"Route queue: {queue}")
     
-    if next_pois:
-        next_poi = next_pois[0]
-        log.info(f"Next POI: id={next_poi['id']}, name={next_poi['name_ru']}")
-        buttons.append([InlineKeyboardButton("➡️ Следующее место", callback_data=f"show_next_{next_poi['id']}")])
+    if queue:
+        buttons.append([InlineKeyboardButton("➡️ Следующее место", callback_data=f"show_next_{queue[0]}")])
     
     keyboard = InlineKeyboardMarkup(buttons) if buttons else None
     
     # Отправляем сообщение
     await message.reply_text(caption, parse_mode='HTML', disable_web_page_preview=False, reply_markup=keyboard)
-    mark_visit(uid, poi['id'])
+    await run_db(mark_visit, uid, poi['id'])
 
 # ── админские команды ───────────────────────────────────────────────────────
+def reset_user(uid: int):
+    with db_write() as c:
+        c.execute("DELETE FROM visit_log WHERE user_id=?", (uid,))
+        c.execute("DELETE FROM poi_visit_count WHERE user_id=?", (uid,))
+        c.execute("DELETE FROM user_tracking WHERE user_id=?", (uid,))
+        c.execute("UPDATE user_stats SET total_distance=0, unique_visited=0 WHERE user_id=?", (uid,))
+
 async def cmd_reset(u: Update, _):
-    with connect_db() as c:
-        c.execute("DELETE FROM visit_log WHERE user_id=?", (u.effective_user.id,))
-        c.execute("DELETE FROM user_tracking WHERE user_id=?", (u.effective_user.id,))
-        c.execute("UPDATE user_stats SET total_distance=0 WHERE user_id=?", (u.effective_user.id,))
+    await run_db(reset_user, u.effective_user.id)
     await u.message.reply_text("✨ История сброшена. Можно исследовать заново!")
 
+# Импорты и так идут по одному через поток БД; lock нужен, чтобы повторный
+# /reload во время импорта не ставил в очередь ещё один полный перечит CSV
+RELOAD_LOCK: Optional[asyncio.Lock] = None
+
 async def cmd_reload(u: Update, _):
-    if u.effective_user.id != u.effective_chat.id:
+    if u.effective_user.id != (ADMIN_ID or u.effective_chat.id):
         return
-    inserted = import_csv()
+    if RELOAD_LOCK.locked():
+        await u.message.reply_text("⏳ CSV уже перечитывается, дождитесь окончания")
+        return
+    async with RELOAD_LOCK:
+        inserted = await run_db(import_csv, force=True)
     await u.message.reply_text(f"✅ CSV перечитан, добавлено новых точек: {inserted}")
 
 # ── FastAPI / bot lifecycle ────────────────────────────────────────────────
-app = FastAPI(title="PushkinBot")
 tg_app = None
 
-@app.on_event("startup")
-async def startup():
-    global tg_app
-    init_db()
-    import_csv()
-    tg_app = ApplicationBuilder().token(BOT_TOKEN).build()
-    
-    # Команды
-    tg_app.add_handler(CommandHandler("start", cmd_start))
-    tg_app.add_handler(CommandHandler("stats", cmd_stats))
-    tg_app.add_handler(CommandHandler("mystats", cmd_mystats))
-    tg_app.add_handler(CommandHandler("route", cmd_route))
-    tg_app.add_handler(CommandHandler("interests", cmd_interests))
-    tg_app.add_handler(CommandHandler("reset", cmd_reset))
-    tg_app.add_handler(CommandHandler("reload", cmd_reload))
-    
-    # Обработчики
-    tg_app.add_handler(MessageHandler(filters.LOCATION, on_location))
-    tg_app.add_handler(CallbackQueryHandler(on_callback))
-    
-    await tg_app.bot.delete_webhook(drop_pending_updates=True)
-    await tg_app.initialize()
+async def prepare_db():
+    await run_db(init_db)
+    await run_db(import_csv)
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    global tg_app, RELOAD_LOCK
+    RELOAD_LOCK = asyncio.Lock()
+    # Отдельное соединение под long-poll и общий keep-alive пул под
+    # ответы/edit_text, чтобы TLS-рукопожатия не повторялись на каждый вызов
+    tg_app = (ApplicationBuilder().token(BOT_TOKEN)
+              .connection_pool_size(256)
+              .pool_timeout(30)
+              .http_version("1.1")
+              .get_updates_connection_pool_size(1)
+              .get_updates_http_version("1.1")
+              .concurrent_updates(True)
+              # Все исходящие вызовы бота — в общем лимите Telegram (~30/с)
+              .rate_limiter(AIORateLimiter())
+              .build())
+    
+    tg_app.add_handlers([
+        # Команды
+        CommandHandler("start", cmd_start),
+        CommandHandler("stats", cmd_stats),
+        CommandHandler("mystats", cmd_mystats),
+        CommandHandler("route", cmd_route),
+        CommandHandler("interests", cmd_interests),
+        CommandHandler("reset", cmd_reset),
+        CommandHandler("reload", cmd_reload),
+        # Обработчики
+        MessageHandler(filters.LOCATION, on_location),
+        CallbackQueryHandler(on_callback),
+    ])
+    
+    # Схема/импорт CSV идут в потоке БД, getMe — в сеть: друг от друга не зависят
+    await asyncio.gather(prepare_db(), tg_app.initialize())
     await tg_app.start()
-    await tg_app.updater.start_polling(drop_pending_updates=True)
-    log.info("Bot started ✅")
+    if PUBLIC_URL:
+        await tg_app.bot.set_webhook(
+            url=f"{PUBLIC_URL}/webhook",
+            drop_pending_updates=True,
+            allowed_updates=ALLOWED_UPDATES,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        # start_polling сам снимает вебхук и сбрасывает накопившиеся апдейты
+        # длинный long-poll: реже просыпаемся впустую при малом трафике
+        await tg_app.updater.start_polling(drop_pending_updates=True, timeout=30,
+                                           allowed_updates=ALLOWED_UPDATES)
+    log.info("Bot started ✅ (%s)", "webhook" if PUBLIC_URL else "polling")
 
-@app.on_event("shutdown")
-async def shutdown():
-    await tg_app.updater.stop()
+    yield
+
+    if tg_app.updater.running:
+        await tg_app.updater.stop()
     await tg_app.stop()
     await tg_app.shutdown()
 
+app = FastAPI(title="PushkinBot", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+VERSION = "2.0"
+
 @app.get("/")
-async def root():
-    return {"status": "ok", "total": poi_count(), "version": "2.0"}
+async def root(request: Request):
+    # Мониторы опрашивают / постоянно: тело меняется только с числом точек,
+    # поэтому на If-None-Match отвечаем 304 без сериализации JSON
+    total = poi_count()
+    etag = f'W/"{total}-{VERSION}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse({"status": "ok", "total": total, "version": VERSION}, headers=headers)
 
 @app.post("/webhook")
-async def noop(_: Request):
-    return Response(status_code=200)
+async def webhook(request: Request):
+    if not PUBLIC_URL:
+        # В режиме polling апдейты берём только у Telegram сами
+        return Response(status_code=404)
+    if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+        return Response(status_code=403)
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        return Response(status_code=400)
+    if not isinstance(data, dict):
+        return Response(status_code=400)
+    try:
+        update = Update.de_json(data, tg_app.bot)
+    except (KeyError, TypeError, ValueError):
+        return Response(status_code=400)
+    if update is None:  # de_json отдаёт None на пустой объект
+        return Response(status_code=400)
+    # Обработку забирает диспетчер PTB из очереди; Telegram отвечаем сразу
+    await tg_app.update_queue.put(update)
+    return Response(status_code=204)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 3000)))
\ No newline at end of file
+    # uvloop + httptools вместо asyncio/h11; access-лог — строка на каждый апдейт
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 3000)),
+                loop="uvloop", http="httptools", access_log=False)
\ No newline at end of file